@@ -1,8 +1,22 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-from scipy.signal import hilbert
+from scipy.fft import fft, ifft, next_fast_len
 from ..units import uV, ms
 
+def analytic_signal(spectrum):
+    """Analytic signal from the FFT of a real signal along the last axis.
+    The positive frequencies are doubled and the negative ones removed, DC
+    and the Nyquist bin of an even length are kept once. The spectrum is
+    overwritten."""
+    N = np.shape(spectrum)[-1]
+    weights = np.zeros(N)
+    weights[0] = 1
+    weights[1:(N+1)//2] = 2
+    if N%2 == 0:
+        weights[N//2] = 1
+    spectrum *= weights
+    return ifft(spectrum, overwrite_x=True, workers=-1)
+
 class HilbertTransform(object):
     def __init__(self, times, flux):
         if len(times) != len(flux):
@@ -10,24 +24,33 @@ class HilbertTransform(object):
         self.N = len(flux)
         self.time = times / ms
         self.flux = flux / uV
-        self.h = hilbert(self.flux)
+        # pad to a length the FFT handles efficiently and cut back afterwards
+        self.h = analytic_signal(fft(self.flux, n=next_fast_len(self.N)))[:self.N]
+        self._real = self.h.real
+        self._imag = self.h.imag
+        # envelope and phase are derived once from the analytic signal
+        self._env = np.abs(self.h)
+        self._phi = np.arctan(self._imag/self._real)
+        # arctan jumps by pi, whenever it goes from +pi/2 to -pi/2
+        self._phi[1:] += np.pi*np.cumsum(np.logical_and(self._phi[:-1] > 0, self._phi[1:] < 0))
 
     def real(self):
-        return np.real(self.h)
+        return self._real
 
     def imag(self):
-        return np.imag(self.h)
+        return self._imag
+
+    def AnalyticSignal(self):
+        return self.time*ms, self.h*uV
 
     def PhaseFunction(self):
-        phi = np.arctan(self.imag()/self.real())
-        jump = np.pi*np.logical_and(phi[:-1] > 0, phi[1:] < 0)
-        phi += np.concatenate([[0], np.cumsum(jump)])
-        return self.time*ms, phi
+        return self.time*ms, self._phi
 
     def EnvelopeFunction(self):
-        return self.time*ms, np.sqrt(self.imag()**2 + self.real()**2)*uV
+        return self.time*ms, self._env*uV
 
     def plot_phase_function(self, fig=None):
+        import matplotlib.pyplot as plt
         if fig is None:
             fig, ax = plt.subplots()
 
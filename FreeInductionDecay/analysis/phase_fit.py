@@ -1,51 +1,51 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-from scipy.optimize import minimize
-from scipy.stats import linregress
-from scipy.ndimage.filters import uniform_filter1d
-from scipy.fftpack import fft, ifft, fftfreq
+from scipy.optimize import OptimizeResult
+from scipy.ndimage import uniform_filter1d
+from scipy.fft import fft, fftfreq
 from ..units import *
-from .hilbert_transform import HilbertTransform
+from .hilbert_transform import HilbertTransform, analytic_signal
 import copy
 import json
-import matplotlib.pyplot as plt
-from ROOT import TMatrixD
-
-def MatrixInvertRoot(M, tol=1e-32):
-    M_root = TMatrixD(np.shape(M)[0], np.shape(M)[1])
-    for i in range(np.shape(M)[0]):
-        for j in range(np.shape(M)[1]):
-            M_root[i][j] = M[i,j]
-    M_root.SetTol(tol)
-    M_root.Invert()
-    M_inv = np.zeros_like(M)
-    for i in range(np.shape(M)[0]):
-        for j in range(np.shape(M)[1]):
-            M_inv[i,j] = M_root[i][j]
-    return M_inv
+
+def linear_regression(x, y):
+    """Slope and intercept of a straight line fit to y(x)."""
+    x_mean = np.mean(x)
+    y_mean = np.mean(y)
+    dx = x - x_mean
+    slope = np.dot(dx, y - y_mean)/np.dot(dx, dx)
+    return slope, y_mean - slope*x_mean
+
+def _import_root():
+    # ROOT is slow to load and only needed to read .root templates
+    try:
+        import ROOT
+    except ImportError:
+        raise ImportError("Reading phase templates from .root files requires PyROOT.")
+    return ROOT
 
 class PhaseFitFID(object):
-    fit_version = {"t3_odd": {"nParams": 3, "func": lambda t, p: p[0] + p[1]*t             + p[2]*t**3},
-                   "t5_odd": {"nParams": 4, "func": lambda t, p: p[0] + p[1]*t             + p[2]*t**3             + p[3]*t**5},
-                   "t7_odd": {"nParams": 5, "func": lambda t, p: p[0] + p[1]*t             + p[2]*t**3             + p[3]*t**5             + p[4]*t**7},
-                   "t3_all": {"nParams": 4, "func": lambda t, p: p[0] + p[1]*t + p[2]*t**2 + p[3]*t**3},
-                   "t4_all": {"nParams": 5, "func": lambda t, p: p[0] + p[1]*t + p[2]*t**2 + p[3]*t**3 + p[4]*t**4},
-                   "t5_all": {"nParams": 6, "func": lambda t, p: p[0] + p[1]*t + p[2]*t**2 + p[3]*t**3 + p[4]*t**4 + p[5]*t**5},
-                   "t6_all": {"nParams": 7, "func": lambda t, p: p[0] + p[1]*t + p[2]*t**2 + p[3]*t**3 + p[4]*t**4 + p[5]*t**5 + p[6]*t**6},
-                   "t7_all": {"nParams": 8, "func": lambda t, p: p[0] + p[1]*t + p[2]*t**2 + p[3]*t**3 + p[4]*t**4 + p[5]*t**5 + p[6]*t**6 + p[7]*t**7},
+    # "powers" lists the power of t that belongs to each fit parameter
+    fit_version = {"t3_odd": {"nParams": 3, "powers": [0, 1, 3]},
+                   "t5_odd": {"nParams": 4, "powers": [0, 1, 3, 5]},
+                   "t7_odd": {"nParams": 5, "powers": [0, 1, 3, 5, 7]},
+                   "t3_all": {"nParams": 4, "powers": [0, 1, 2, 3]},
+                   "t4_all": {"nParams": 5, "powers": [0, 1, 2, 3, 4]},
+                   "t5_all": {"nParams": 6, "powers": [0, 1, 2, 3, 4, 5]},
+                   "t6_all": {"nParams": 7, "powers": [0, 1, 2, 3, 4, 5, 6]},
+                   "t7_all": {"nParams": 8, "powers": [0, 1, 2, 3, 4, 5, 6, 7]},
                    }
 
-    def __init__(self, probe=None, edge_ignore=0.1*ms, frac=np.exp(-1), smoothing=True, tol=1e-5, n_smooth=3, phase_template_file=None, fit_range_template_file=None, fit_mode="t5_odd"):
+    def __init__(self, probe=None, edge_ignore=0.1*ms, frac=np.exp(-1), smoothing=True, n_smooth=3, phase_template_file=None, fit_range_template_file=None, fit_mode="t5_odd"):
         self.t0 = probe.time_pretrigger
         self.pretrigger = probe.time_pretrigger
         self.readout_length = probe.readout_length
         self.edge_ignore = edge_ignore
         self.frac = frac
         self.smoothing = smoothing
-        self.tol = tol
         self.n_smooth = n_smooth
         self.nParams = self.fit_version[fit_mode]["nParams"]
-        self.fit_func = self.fit_version[fit_mode]["func"]
+        self.powers = np.array(self.fit_version[fit_mode]["powers"])
         if phase_template_file is not None:
             self.load_phase_template(phase_template_file)
         if fit_range_template_file is not None:
@@ -53,11 +53,13 @@ class PhaseFitFID(object):
 
     def load_phase_template(self, path):
         if path.endswith(".root"):
-            import ROOT
+            ROOT = _import_root()
             file = ROOT.TFile.Open(path,"READ")
-            self.phase_template = np.reshape(file.Get("PhaseTemplate"), (-1, 4096))
+            phase_template = np.reshape(file.Get("PhaseTemplate"), (-1, 4096))
         else:
-            self.phase_template = np.genfromtxt(path, delimiter=",")
+            phase_template = np.genfromtxt(path, delimiter=",")
+        # one contiguous row per probe
+        self.phase_template = np.ascontiguousarray(phase_template, dtype=np.float64)
 
     def load_fit_range_template(self, path):
         with open(path, "r") as open_file:
@@ -65,8 +67,8 @@ class PhaseFitFID(object):
         self.fit_range_template = {entry["Probe ID"]: (entry["Fid Begin"], entry["Fid End"]) for entry in raw_data}
 
     def get_fit_range(self):
-        t_min = np.min(self.time)
-        t_max = np.max(self.time)
+        t_min = self.tmin
+        t_max = self.tmax
         if self.pretrigger is not None:
             t_min = np.max([t_min, self.pretrigger])
         if self.readout_length is not None:
@@ -77,56 +79,88 @@ class PhaseFitFID(object):
         thres = np.max(self.env[mask_edge])*self.frac
         mask = np.logical_and(mask_edge, self.env > thres)
 
-        t_min = np.min(self.time[mask])
-        t_max = np.min(self.time[np.logical_and(self.time > t_min, np.logical_not(mask))])
-        return np.array([t_min, t_max])
+        # time is sorted: the range runs from the first point above threshold
+        # to the next point below it
+        i0 = np.argmax(mask)
+        i1 = i0 + np.argmin(mask[i0:])
+        return np.array([self.time[i0], self.time[i1]])
 
     def apply_smoothing(self):
-        N = int(self.window_size/np.diff(self.time)[0])
+        N = int(self.window_size/self.dt)
         if N%2 == 0:
             N += 1
         return uniform_filter1d(self.phase_raw, size=N)
 
+    def fit_func(self, t, p):
+        """Evaluates the fit polynomial with parameters p at t."""
+        # pad the parameters with zeros for the powers that are not fitted
+        coeffs = np.zeros(self.powers[-1]+1)
+        coeffs[self.powers] = p
+        return np.polynomial.polynomial.polyval(t, coeffs)
+
     def get_noise(self):
         return np.std(self.flux[self.time < self.pretrigger])
 
     def chi2_fit(self):
-        mask = np.logical_and(self.time > np.min(self.t_range), self.time < np.max(self.t_range))
+        """The fit functions are linear in their parameters, so the chi2 is
+        minimized by a weighted linear least squares solution. No iterative
+        minimizer and start values are needed."""
         self.width = (self.t_range[1]-self.t_range[0])
-        chi2 = lambda p: np.sum((self.fit_func((self.time[mask]-self.t0)/self.width, p) - self.phase[mask])**2*(self.env[mask]/self.noise)**2)
-        x0 = np.random.normal(scale=0.1, size=self.nParams)
-        x0[0] = self.offset_estimate*(1+x0[0])
-        x0[1] = self.f_estimate*self.width*(1+x0[1])
-        res = minimize(chi2, x0, tol=self.tol, method="L-BFGS-B")
-        return res
+        t = (self.time[self.fit_slice]-self.t0)/self.width
+        phi = self.phase[self.fit_slice]
+        w = self.env[self.fit_slice]/self.noise
+        # design matrix, one column per fit parameter, the columns are picked
+        # from the Vandermonde matrix instead of raising t to each power
+        A = np.vander(t, self.powers[-1]+1, increasing=True)[:, self.powers]
+        # weighting the design matrix in place gives the constant Jacobian of
+        # the weighted residuals (A x - phi)*w
+        A *= w[:, None]
+        phi_w = phi*w
+        x, residuals, rank, _ = np.linalg.lstsq(A, phi_w, rcond=None)
+        # lstsq already returns the weighted sum of squared residuals, it is
+        # empty only for rank deficient or underdetermined fits
+        if residuals.size:
+            chi2 = residuals[0]
+        else:
+            chi2 = np.sum((np.dot(A, x) - phi_w)**2)
+        return OptimizeResult(x=x, fun=chi2, jac=A, success=rank == len(self.powers))
 
     def fit(self, time, flux, probe_id=0):
         self.time = time
+        # the FID is sampled uniformly
+        self.dt = time[1] - time[0]
+        self.tmin = time[0]
+        self.tmax = time[-1]
         self.flux = flux
         hilbert = HilbertTransform(self.time, self.flux)
         _, self.env =  hilbert.EnvelopeFunction()
         _, self.phase_raw =  hilbert.PhaseFunction()
         self.noise = self.get_noise()
         self.t_range = self.get_fit_range()
-        mask = np.logical_and(self.t_range[0] < self.time, self.time < self.t_range[1])
-        self.f_estimate, self.offset_estimate, _, _, _ = linregress(self.time[mask]-self.t0, self.phase_raw[mask])
+        # time is sorted, so the points with t_min < t < t_max are a slice and
+        # can be taken as views instead of copies
+        self.fit_slice = slice(np.searchsorted(self.time, np.min(self.t_range), side="right"),
+                               np.searchsorted(self.time, np.max(self.t_range), side="left"))
+        self.f_estimate, self.offset_estimate = linear_regression(self.time[self.fit_slice]-self.t0, self.phase_raw[self.fit_slice])
         if self.smoothing:
             self.window_size = self.n_smooth*2*np.pi/self.f_estimate
             self.phase = self.apply_smoothing()
         else:
-            self.phase = self.phase_raw[:]
+            self.phase = self.phase_raw
 
         if hasattr(self, "phase_template"):
-            self.phase -= self.phase_template[probe_id]
+            # not in place, phase can be the same array as phase_raw
+            self.phase = self.phase - self.phase_template[probe_id]
 
         self.res = self.chi2_fit()
-        self.n_point_in_fit = np.sum(np.logical_and(self.time > np.min(self.t_range), self.time < np.max(self.t_range)))
+        self.n_point_in_fit = self.fit_slice.stop - self.fit_slice.start
         self.frequency = self.res.x[1]/self.width
         self.phi0 = self.res.x[0]
 
         return self.frequency
 
     def plot(self):
+        import matplotlib.pyplot as plt
         plt.plot(self.time/ms, self.phase_raw - self.phi0 - self.frequency*(self.time-self.t0), color="b", label="raw FID")
         if self.smoothing:
             plt.plot(self.time/ms, self.phase - self.phi0 - self.frequency*(self.time-self.t0), color="red", label="smoothed FID")
@@ -162,9 +196,9 @@ class PhaseFitRan(object):
             self.load_fit_range_template(fit_range_template_path)
 
     def load_phase_template(self, path):
-        from ROOT import TTree, TFile, gROOT, AddressOf
+        ROOT = _import_root()
         # struct defined as in here: https://cdcvs.fnal.gov/redmine/projects/gm2field/repository/revisions/develop/entry/include/RootTreeStructs.hh#L657
-        gROOT.ProcessLine("""struct fidSettings_t {
+        ROOT.gROOT.ProcessLine("""struct fidSettings_t {
             Double_t const_baseline;
             Double_t const_baseline_used;
             Double_t edge_width;
@@ -214,11 +248,10 @@ class PhaseFitRan(object):
             char PhaseTemplateFile[128];
             char TemplatePath[128];
             char FitRangeTemplateFile[128];}""")
-        from ROOT import fidSettings_t
-        data = fidSettings_t()
-        f = TFile(path)
+        data = ROOT.fidSettings_t()
+        f = ROOT.TFile(path)
         tree = f.Get("SettingsCollector/settings")
-        tree.SetBranchAddress("FixedProbeFid", AddressOf(data,"const_baseline"))
+        tree.SetBranchAddress("FixedProbeFid", ROOT.AddressOf(data,"const_baseline"))
         tree.GetEntry(0)
         self.phase_template = np.array(np.frombuffer(data.PhaseTemplate, dtype='double').reshape([378,4096]))
         self.frequency_template = np.array(np.frombuffer(data.FreqTemplate, dtype='double').reshape(378))
@@ -229,102 +262,133 @@ class PhaseFitRan(object):
         self.fit_range_template = {entry["Probe ID"]: (entry["Fid Begin"], entry["Fid End"]) for entry in raw_data}
 
     def apply_smoothing(self, flux, MaxWidth=1000, start=0, end=4096):
-        nWidth = int(np.min([self.smoothWidth, MaxWidth]))
-        smoothed = flux[:]
+        nWidth = int(min(self.smoothWidth, MaxWidth))
+        smoothed = np.array(flux[start:end], dtype=np.float64)
+        # moving average over [j-(nWidth-1), j+nWidth), truncated at start
+        # and end, calculated from the cumulative sum in O(N)
+        # the windows are the same in every iteration
+        j = np.arange(len(smoothed))
+        lo = np.maximum(j-(nWidth-1), 0)
+        hi = np.minimum(j+nWidth, len(smoothed))
+        count = hi - lo
+        cumsum = np.zeros(len(smoothed)+1)
         for iter in range(self.smooth_iterations):
-            smoothed = np.array([np.mean(smoothed[max([j-(nWidth-1), start]):min([j+nWidth, end])]) for j in range(start, end)])
+            np.cumsum(smoothed, out=cumsum[1:])
+            np.subtract(cumsum[hi], cumsum[lo], out=smoothed)
+            smoothed /= count
         return smoothed
 
     def phase_from_fft(self, time, flux, WindowFilterLow=0., WindowFilterHigh=200000.):
         # identical to hilbert except the filter line
-        freq = fftfreq(len(flux), d=np.diff(time)[0]/s)
-        fid_fft_filtered = fft(flux)
-        fid_fft_filtered[np.logical_not(np.logical_and(WindowFilterLow<=np.abs(freq), np.abs(freq)<=WindowFilterHigh))] = 0+0j
-        filtered_wf = np.real(ifft(fid_fft_filtered))
-        wf_im = np.real(ifft(fid_fft_filtered*(-1j)*np.sign(freq)))
-
-        phi = np.arctan2(wf_im, filtered_wf)
-        env = np.sqrt(filtered_wf**2 + wf_im**2)
-        jump = 1*(phi[:-1] - phi[1:] > 4.71)
-        jump -= 1*(phi[1:] - phi[:-1] > 4.71)
-        phi += np.concatenate([[0], 2*np.pi*np.cumsum(jump)])
+        # flux can hold several FIDs along the first axis
+        N = np.shape(flux)[-1]
+        freq = fftfreq(N, d=(time[1]-time[0])/s)
+        abs_freq = np.abs(freq)
+        # workers=-1 spreads the FFTs of several FIDs over all cores
+        fid_fft_filtered = fft(flux, workers=-1)
+        fid_fft_filtered[..., (abs_freq < WindowFilterLow) | (abs_freq > WindowFilterHigh)] = 0+0j
+        # the real part of the analytic signal is the filtered waveform, the
+        # imaginary part its Hilbert transform
+        analytic = analytic_signal(fid_fft_filtered)
+        filtered_wf = np.real(analytic)
+
+        phi = np.angle(analytic)
+        env = np.abs(analytic)
+        # remove the 2 pi jumps, a step larger than 4.71 rad counts as jump
+        phi = np.unwrap(phi, discont=4.71)
         return filtered_wf, phi, env
 
     def linear_fit(self, x, y, start, stop, NPar):
-        N_Eq = stop - start + 1
-        MatrixData = np.array([[x[start+i]**j for j in range(NPar)] for i in range(N_Eq)], dtype=np.float64)
-        RHSData = np.array(y[start:stop+1], dtype=np.float64)
+        if NPar == 2:
+            # straight line, closed form without the normal equations
+            slope, intercept = linear_regression(x[start:stop+1], y[start:stop+1])
+            return slope, intercept, None, None, None
+        MatrixData = np.vander(np.asarray(x[start:stop+1], dtype=np.float64), NPar, increasing=True)
+        RHSData = np.asarray(y[start:stop+1], dtype=np.float64)
+        # solve the normal equations directly, no explicit inverse needed
         M = np.matmul(MatrixData.T,MatrixData)
         b = np.matmul(MatrixData.T,RHSData)
-        #M_inv = np.linalg.inv(M)
-        #M_inv = np.linalg.pinv(M)
-        M_inv = MatrixInvertRoot(M, tol=1e-32)
-        solution = np.matmul(M_inv,b)
+        solution = np.linalg.solve(M, b)
         return solution[1], solution[0], None, None, None
 
     def get_fit_range(self, env, filtered_wf, dt):
         Length = len(env)
-        nIgnore = np.floor(self.edge_ignore/dt);
+        nIgnore = int(np.floor(self.edge_ignore/s/dt))
 
         # Find the maximum of the envelope
-        k = np.argmax(env[nIgnore:-nIgnore]) + nIgnore + nIgnore # bug
+        k = int(np.argmax(env[nIgnore:Length-nIgnore])) + nIgnore
 
         #Start from the next falling zero-crossing
-        while True:
-            if ((filtered_wf[k]>=0 and filtered_wf[k+1]<0) or k>=Length-nIgnore-1): break
-            k+=1
+        end = Length-nIgnore-1
+        if k < end:
+            falling = np.logical_and(filtered_wf[k:end]>=0, filtered_wf[k+1:end+1]<0)
+            k = k + int(np.argmax(falling)) if falling.any() else end
         idx_start = k-2 if k>=0 else k
 
         # Find the point where the amplitude dropped to fraction
         rel = env[k]
-        while True:
-            if env[k]<rel*self.start_amplitude or k>=Length-nIgnore: break
-            k+=1
+        # stay on the last sample, the backward search starts at k
+        end = min(Length-nIgnore, Length-1)
+        if k < end:
+            dropped = env[k:end] < rel*self.start_amplitude
+            k = k + int(np.argmax(dropped)) if dropped.any() else end
 
         #End at the previous falling zero-crossing
-        while True:
-            if (k<=nIgnore+1): break
-            if (filtered_wf[k]<=0 and filtered_wf[k-1]>0): break
-            k-=1
+        begin = nIgnore+2
+        if k >= begin:
+            falling = np.logical_and(filtered_wf[begin:k+1]<=0, filtered_wf[begin-1:k]>0)
+            k = begin + int(np.flatnonzero(falling)[-1]) if falling.any() else nIgnore+1
         idx_stop = k+2 if k<=Length-3 else k
 
         return idx_start, idx_stop
 
     def fit(self, times, fluxes, probe_id):
+        return self.fit_batch(times, np.atleast_2d(fluxes), [probe_id])[0]
+
+    def fit_batch(self, times, fluxes, probe_ids):
+        """Fits several FIDs sampled at the same times, one per row of fluxes.
+        The baseline subtraction and the FFTs are done for all rows at once,
+        only the fit range and the linear fits run per probe."""
         time = times + self.t0
-        dt = np.diff(time)[0]/s
-        const_baseline = np.mean(fluxes[self.baseline_start:self.baseline_end])
+        # time in seconds for the linear fits, converted only once
+        t_s = np.ascontiguousarray(time/s, dtype=np.float64)
+        dt = (time[1]-time[0])/s
+        fluxes = np.asarray(fluxes, dtype=np.float64)
+        const_baseline = np.mean(fluxes[:, self.baseline_start:self.baseline_end], axis=-1, keepdims=True)
         flux = fluxes - const_baseline
         filtered_wf, phase_raw, env = self.phase_from_fft(time, flux) # same as hilbert but with additional filtering
+        return np.array([self.fit_probe(t_s, dt, filtered_wf[i], phase_raw[i], env[i], probe_id)
+                         for i, probe_id in enumerate(probe_ids)])
+
+    def fit_probe(self, t_s, dt, filtered_wf, phase_raw, env, probe_id):
         if self.use_phase_template:
             phase_raw = phase_raw - self.phase_template[probe_id]
         if self.use_fit_range_template:
             idx_start, idx_stop = self.fit_range_template[probe_id][0], self.fit_range_template[probe_id][1]
         else:
             idx_start, idx_stop = self.get_fit_range(env, filtered_wf, dt)
-        #f_estimate, offset_estimate, _, _, _ = linregress(time[idx_start:idx_stop], phase_raw[idx_start:idx_stop])
-        f_estimate, offset_estimate, _, _, _ = self.linear_fit(time/s, phase_raw, idx_start, idx_stop, 2)
+        #f_estimate, offset_estimate = linear_regression(time[idx_start:idx_stop], phase_raw[idx_start:idx_stop])
+        f_estimate, offset_estimate, _, _, _ = self.linear_fit(t_s, phase_raw, idx_start, idx_stop, 2)
         f_estimate = f_estimate/(2*np.pi)
         if self.use_phase_template:
             f_estimate += self.frequency_template[probe_id]
         self.smoothWidth = np.floor(1/f_estimate/dt) if 20000 <= f_estimate <= 100000 else np.floor(1/51000/dt)
         phase = self.apply_smoothing(phase_raw)
         idx_stop_short = idx_start + int(np.round((idx_stop-idx_start)*self.LengthReduction))
-        #freq, offset, _, _, _ = linregress(time[idx_start:idx_stop], phase[idx_start:idx_stop])
-        freq, offset, _, _, _ = self.linear_fit(time/s, phase, idx_start, idx_stop_short, 2)
+        #freq, offset = linear_regression(time[idx_start:idx_stop], phase[idx_start:idx_stop])
+        freq, offset, _, _, _ = self.linear_fit(t_s, phase, idx_start, idx_stop_short, 2)
         freq = freq/(2*np.pi)
         if self.use_phase_template:
             freq += self.frequency_template[probe_id]
         return freq
 
 class PhaseFitEcho(PhaseFitFID):
-    def __init__(self, frac=np.exp(-1), probe=None, smoothing=True, tol=1e-5, n_smooth=3):
+    def __init__(self, frac=np.exp(-1), probe=None, smoothing=True, n_smooth=3):
         self.t0 = 2*probe.readout_length-probe.time_pretrigger
         self.pretrigger = probe.time_pretrigger
         self.readout_length = probe.readout_length
         self.frac = frac
         self.smoothing = True
-        self.tol = tol
         self.n_smooth = n_smooth
 
     def get_fit_range(self):
@@ -338,6 +402,7 @@ class PhaseFitEcho(PhaseFitFID):
         return np.array([t_start, t_stop])
 
     def plot(self):
+        import matplotlib.pyplot as plt
         plt.plot(self.time/ms, self.phase_raw - self.phi0 - self.frequency*(self.time-self.t0), color="b", label="raw FID")
         if self.smoothing:
             plt.plot(self.time/ms, self.phase - self.phi0 - self.frequency*(self.time-self.t0), color="red", label="smoothed FID")
@@ -184,12 +184,10 @@ class ProbeSimulator(object):
         IndexZ = np.floor((self.fSampleL/2. + Z)/self.fGridSize)
         IndexR = np.floor(R/self.fGridSize)
 
-        avg_z = 0.0
-        for r_idx, z_idx, phi, z in zip(IndexR, IndexZ, Phi, Z):
-          idx = int(r_idx*self.fSampleDimL+z_idx)
-          B_Field = np.sqrt((self.fB_coil_L[idx])**2 + (self.fB_coil_T[idx]*np.cos(phi))**2)
-          Signal = B_Field*np.sin(self.fPulseEff*B_Field*np.pi/2.0)
-          avg_z += z*Signal
+        idx = (IndexR*self.fSampleDimL+IndexZ).astype(int)
+        B_Field = np.sqrt((self.fB_coil_L[idx])**2 + (self.fB_coil_T[idx]*np.cos(Phi))**2)
+        Signal = B_Field*np.sin(self.fPulseEff*B_Field*np.pi/2.0)
+        avg_z = np.sum(Z*Signal)
         avg_z /= float(NSpins)
         self.fProbeCenter[2] = avg_z
 
@@ -215,12 +213,9 @@ class ProbeSimulator(object):
         FreqMax = np.max(self.fSpinFreq)
         df = (FreqMax-FreqMin)/float(self.fNFreq)
 
-        self.fWeightFunction = np.zeros(self.fNFreq)
-
         index = np.floor((self.fSpinFreq-FreqMin)/df);
         index[index>=self.fNFreq] = self.fNFreq-1
-        for i, idx in enumerate(index):
-            self.fWeightFunction[int(idx)] += self.fSpinSignal[i]
+        self.fWeightFunction = np.bincount(index.astype(int), weights=self.fSpinSignal, minlength=self.fNFreq)
 
         self.fFreqBins = FreqMin+df/2.0+df*np.arange(0, self.fNFreq)
         self.fAverageFrequency = np.sum(self.fFreqBins*self.fWeightFunction) / np.sum(self.fWeightFunction)
@@ -260,53 +255,52 @@ class ProbeSimulator(object):
         B_loop_L = np.zeros(AuxN*self.fSampleDimT)
         B_loop_T = np.zeros(AuxN*self.fSampleDimT)
 
-        for i in range(0,self.fSampleDimT):
-            for j in range(0, int(AuxN/2+1)):
-                index = int(i*AuxN+j)
+        # the loop segments are the same for all grid points
+        dPhi = 2*np.pi/ float(self.fCoilPhiNSeg)
+        dl = dPhi*self.fCoilR
 
-                dPhi = 2*np.pi/ float(self.fCoilPhiNSeg)
-                dl = dPhi*self.fCoilR
+        Phi = dPhi*np.arange(0, self.fCoilPhiNSeg)
+        dlX = -dl*np.sin(Phi)
+        dlY = dl*np.cos(Phi)
+        X = -self.fCoilR*np.cos(Phi)
 
-                Phi = dPhi*np.arange(0, self.fCoilPhiNSeg)
-                dlX = -dl*np.sin(Phi)
-                dlY = dl*np.cos(Phi)
+        # all radial grid points i are evaluated at once, shape (fSampleDimT, fCoilPhiNSeg)
+        i = np.arange(0, self.fSampleDimT)
+        Y = i[:, None]*self.fGridSize-self.fCoilR*np.sin(Phi)
+        for j in range(0, int(AuxN/2+1)):
+            index = i*AuxN+j
 
-                Z = -AuxL/2.0+j*self.fGridSize
-                Y = i*self.fGridSize-self.fCoilR*np.sin(Phi)
-                X = -self.fCoilR*np.cos(Phi)
+            Z = -AuxL/2.0+j*self.fGridSize
 
-                R = np.sqrt(X**2+Y**2+Z**2)
+            R3 = np.sqrt(X**2+Y**2+Z**2)**3
 
-                B_loop_T[index] += np.sum((-Z*dlX)/R**3)
-                B_loop_L[index] += np.sum((Y*dlX-X*dlY)/R**3)
-                if j < AuxN/2:
-                    B_loop_T[(i+1)*AuxN-1-j] = -B_loop_T[index]
-                    B_loop_L[(i+1)*AuxN-1-j] = B_loop_L[index]
+            B_loop_T[index] += np.sum((-Z*dlX)/R3, axis=-1)
+            B_loop_L[index] += np.sum((Y*dlX-X*dlY)/R3, axis=-1)
+            if j < AuxN/2:
+                B_loop_T[(i+1)*AuxN-1-j] = -B_loop_T[index]
+                B_loop_L[(i+1)*AuxN-1-j] = B_loop_L[index]
 
         # Adding contributions from coils
         CoilShift = 0
         if (self.fCoilN>1):
           CoilShift = self.fCoilL/(self.fCoilN-1)
 
+        # indices of the full (fSampleDimT, fSampleDimL) sample grid
+        i, j = np.meshgrid(np.arange(0, self.fSampleDimT), np.arange(0, self.fSampleDimL), indexing="ij")
+        index = (i*self.fSampleDimL+j).ravel()
+        Offset0 = int(np.floor((AuxL+self.fCoilL-self.fSampleL)/self.fGridSize/2.0))
         for k in range(0, self.fCoilN):
-            Offset0 = int(np.floor((AuxL+self.fCoilL-self.fSampleL)/self.fGridSize/2.0))
-            for i in range(0, self.fSampleDimT):
-            	for j in range(0, self.fSampleDimL):
-                    index = i*self.fSampleDimL+j
-                    index_loop = 0
-                    if (self.CoilOption==0):
-                        index_loop = int(i*AuxN + ((j + Offset0)*self.fGridSize - k* CoilShift)/self.fGridSize)
-                    else:
-                        index_loop = int(i*AuxN + ((j + Offset0)*self.fGridSize - self.fCoilShiftConfig[k])/self.fGridSize)
-
-                    self.fB_coil_T[index] += B_loop_T[index_loop]
-                    self.fB_coil_L[index] += B_loop_L[index_loop]
-                    if k==0:
-                        self.fPosY[index] = i*self.fGridSize
-                        self.fPosZ[index] = -self.fSampleL/2.0+j*self.fGridSize
+            if (self.CoilOption==0):
+                index_loop = (i*AuxN + ((j + Offset0)*self.fGridSize - k* CoilShift)/self.fGridSize).astype(int).ravel()
+            else:
+                index_loop = (i*AuxN + ((j + Offset0)*self.fGridSize - self.fCoilShiftConfig[k])/self.fGridSize).astype(int).ravel()
+
+            self.fB_coil_T[index] += B_loop_T[index_loop]
+            self.fB_coil_L[index] += B_loop_L[index_loop]
+        self.fPosY[index] = (i*self.fGridSize).ravel()
+        self.fPosZ[index] = (-self.fSampleL/2.0+j*self.fGridSize).ravel()
 
         # Normalize
         B_Center_L = self.fB_coil_L[int(self.fSampleDimT/2*self.fSampleDimL+self.fSampleDimL/2)]
-        for i in range(0, self.fSampleDimL*self.fSampleDimT):
-          self.fB_coil_T[i]/=B_Center_L
-          self.fB_coil_L[i]/=B_Center_L
+        self.fB_coil_T /= B_Center_L
+        self.fB_coil_L /= B_Center_L
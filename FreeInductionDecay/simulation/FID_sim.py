@@ -2,6 +2,36 @@
 import numpy as np
 from scipy import integrate
 from ..units import *
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+def _flux_numpy(times, omega, phase, weight_x, weight_z):
+    """Sum of the cell contributions weight_x*cos(omega*t-phase) +
+    weight_z*sin(omega*t-phase) for each time. Builds the (cells x times)
+    argument matrix, so the caller has to chunk long time series."""
+    argument = np.outer(omega, times) - phase[:, None]
+    # reduce over cells as matrix-vector products instead of
+    # broadcasting the weights into full (cells x times) arrays
+    return np.dot(weight_x, np.cos(argument)) + np.dot(weight_z, np.sin(argument))
+
+def _flux_loop(times, omega, phase, weight_x, weight_z):
+    """Same as _flux_numpy but as explicit loops for numba. The sum over cells
+    is accumulated per time, the (cells x times) matrix is never stored."""
+    out = np.empty(times.size)
+    for i in prange(times.size):
+        acc = 0.
+        for j in range(omega.size):
+            arg = omega[j]*times[i] - phase[j]
+            acc += weight_x[j]*np.cos(arg) + weight_z[j]*np.sin(arg)
+        out[i] = acc
+    return out
+
+if njit is not None:
+    _flux_kernel = njit(parallel=True, fastmath=True, cache=True)(_flux_loop)
+else:
+    _flux_kernel = _flux_numpy
 
 class UnitVectorArray(object):
     """This class helps keeping track of different coordinate systems.
@@ -53,10 +83,14 @@ class UnitVectorArray(object):
         self._z = T*np.sin(phase)
 
 class FID_simulation(object):
-    def __init__(self, probe, b_field, N_cells, seed):
+    def __init__(self, probe, b_field, N_cells, seed, dtype=np.float64):
         self.B_field = b_field
         self.probe = probe
         self.rng = np.random.RandomState(seed)
+        # floating point type of the flux calculation in generate_FID,
+        # np.float32 is about twice as fast but the phase of the cells is only
+        # accurate to ~1e-4 rad after a few ms
+        self.dtype = dtype
 
         self.initialize_cells(N_cells)
         # by initializing we want to start in equalibrium
@@ -74,26 +108,43 @@ class FID_simulation(object):
         self.cells_x, self.cells_y, self.cells_z = self.probe.random_samples(self.rng, N_cells)
 
         # calculate external field at cell
-        B0 = np.array([self.B_field(x, y, z) for x, y, z in zip(self.cells_x, self.cells_y, self.cells_z)])
-        self.cells_B0_x = B0[:,0]
-        self.cells_B0_y = B0[:,1]
-        self.cells_B0_z = B0[:,2]
-        self.cells_B0 = np.sqrt(np.sum(B0**2, axis=-1))
+        B0 = self.field_at_cells(self.B_field)
+        self.cells_B0_x = B0[0]
+        self.cells_B0_y = B0[1]
+        self.cells_B0_z = B0[2]
+        self.cells_B0 = np.sqrt(np.sum(B0**2, axis=0))
+        # lamor frequency of the cells, used whenever the cells precess
+        self.cells_omega = self.probe.material.gyromagnetic_ratio*self.cells_B0
 
         # calculate coil field at cell
-        B1 = np.array([self.probe.coil.B_field(x, y, z) for x, y, z in zip(self.cells_x, self.cells_y, self.cells_z)])
-        self.cells_B1_x = B1[:,0]
-        self.cells_B1_y = B1[:,1]
-        self.cells_B1_z = B1[:,2]
-        self.cells_B1 = np.sqrt(np.sum(B1**2, axis=-1))
+        B1 = self.field_at_cells(self.probe.coil.B_field)
+        self.cells_B1_x = B1[0]
+        self.cells_B1_y = B1[1]
+        self.cells_B1_z = B1[2]
+        self.cells_B1 = np.sqrt(np.sum(B1**2, axis=0))
 
         # calculate magnetization of cells
         # dipoles are aligned with the external field at the beginning
         # that is the amplitude not the orientation
         self.cells_magnetization = self.probe.magnetization(self.cells_B0)
 
+    def field_at_cells(self, field):
+        """Evaluates field(x, y, z) -> [B_x, B_y, B_z] at all cells and returns
+        an array of shape (3, N_cells). The field is called once with the cell
+        arrays, components that do not depend on the position may be scalars.
+        Fields that only accept scalars or do not return three components of
+        the cell shape are evaluated cell by cell instead."""
+        shape = self.cells_x.shape
+        try:
+            B = field(self.cells_x, self.cells_y, self.cells_z)
+            if len(B) == 3:
+                return np.array([np.broadcast_to(np.asarray(B_i, dtype=np.float64), shape) for B_i in B])
+        except (TypeError, ValueError):
+            pass
+        return np.array([field(x, y, z) for x, y, z in zip(self.cells_x, self.cells_y, self.cells_z)], dtype=np.float64).T
+
     def frequency_spectrum(self):
-        omega_mixed = (self.probe.material.gyromagnetic_ratio*self.cells_B0-2*np.pi*self.probe.mix_down)
+        omega_mixed = self.cells_omega-2*np.pi*self.probe.mix_down
         weights = np.sqrt(self.cells_B1_x**2+self.cells_B1_z**2)*self.cells_mu.T
         return omega_mixed, weights/np.mean(weights)
 
@@ -236,36 +287,53 @@ class FID_simulation(object):
         else:
             t = np.atleast_1d(time)
 
+        N_pre = 0
         if pretrigger:
             N_pre =  int(self.probe.time_pretrigger*self.probe.sampling_rate_offline)
             t = t[:-N_pre]
 
-        magnitude = np.sqrt((self.probe.material.gyromagnetic_ratio*self.cells_B0)**2 + 1/self.probe.material.T2**2)
-        omega_mixed = (self.probe.material.gyromagnetic_ratio*self.cells_B0-2*np.pi*self.probe.mix_down)
-
-        flux = []
-        chunks = int(self.N_cells* len(t) / max_memory + 1)
+        magnitude = np.sqrt(self.cells_omega**2 + 1/self.probe.material.T2**2)
+        omega_mixed = self.cells_omega-2*np.pi*self.probe.mix_down
+
+        # the per cell weights do not change with time, so they are calculated
+        # once as arrays over all cells and not inside the time chunks
+        # this is equal to Bx * dmu_x_dt + By * dmu_y_dt + Bz * dmu_z_dt
+        # already assumed that dmu_y_dt is 0, so we can leave out that term
+        amplitude = self.probe.coil.turns * mu0 * np.pi * self.probe.coil.radius**2 * self.cells_magnetization * magnitude / np.mean(self.cells_B1)
+        amplitude_x = amplitude*self.cells_B1_x
+        amplitude_z = amplitude*self.cells_B1_z
+        # normalize the weights, so that they stay in range for single precision
+        scale = np.max(np.abs([amplitude_x, amplitude_z]))
+        amplitude_x = amplitude_x/scale
+        amplitude_z = amplitude_z/scale
+        omega_kernel = omega_mixed.astype(self.dtype)
+
+        # the flux is filled chunk by chunk into one array, that already
+        # contains the zeros of the pretrigger window
+        flux = np.zeros(N_pre+len(t))
+        start = N_pre
+        # the numba kernel does not store the (cells x times) matrix, chunking
+        # is only needed to limit the memory of the numpy implementation
+        chunks = 1 if njit is not None else int(self.N_cells* len(t) / max_memory + 1)
         t0 = t[0]
         for this_t in np.array_split(t, chunks):
             this_t = this_t - t0
-            argument = np.outer(omega_mixed,this_t) - self.cells_mu.phase[:, None]
-            # this is equal to Bx * dmu_x_dt + By * dmu_y_dt + Bz * dmu_z_dt
-            # already assumed that dmu_y_dt is 0, so we can leave out that term
-            weight_x = self.cells_B1_x/np.mean(self.cells_B1)
-            weight_z = self.cells_B1_z/np.mean(self.cells_B1)
-            B_x_dmu_dt = self.cells_mu.T[:, None]*magnitude[:, None]*(weight_x[:, None]*np.cos(argument) + weight_z[:, None]*np.sin(argument))*(np.exp(-this_t/self.probe.material.T2)[:, None]).T
-            #return self.coil.turns * mu0 * np.sum(B_x_dmu_dt/self.cells_B1[:, None]*self.cells_magnetization[:, None], axis=0) * np.pi * self.coil.radius**2
-            flux.append(self.probe.coil.turns * mu0 * np.sum(B_x_dmu_dt*self.cells_magnetization[:, None], axis=0) * np.pi * self.probe.coil.radius**2)
+            mu_T = self.cells_mu.T
+            mu_phase = self.cells_mu.phase
+            B_x_dmu_dt = _flux_kernel(this_t.astype(self.dtype), omega_kernel,
+                                      mu_phase.astype(self.dtype),
+                                      (mu_T*amplitude_x).astype(self.dtype),
+                                      (mu_T*amplitude_z).astype(self.dtype))
+            flux[start:start+len(this_t)] = scale * B_x_dmu_dt * np.exp(-this_t/self.probe.material.T2)
+            start += len(this_t)
             t0 += this_t[-1]
             self.cells_mu.set_L_T_phase(self.cells_mu.L,
-                                        self.cells_mu.T * np.exp(-this_t[-1]/self.probe.material.T2),
-                                        self.cells_mu.phase - omega_mixed*this_t[-1])
-        flux = np.concatenate(flux)/self.N_cells
+                                        mu_T * np.exp(-this_t[-1]/self.probe.material.T2),
+                                        mu_phase - omega_mixed*this_t[-1])
+        flux /= self.N_cells
 
         if pretrigger:
-            N_pre =  int(self.probe.time_pretrigger*self.probe.sampling_rate_offline)
             t = np.arange(0, self.probe.readout_length, 1/self.probe.sampling_rate_offline)
-            flux = np.concatenate([np.zeros(N_pre), flux])
         if noise is not None:
             FID_noise = noise(t)
             flux += FID_noise
@@ -356,10 +424,10 @@ class FID_simulation(object):
 
         central_cell = np.argmin(self.cells_x**2 + self.cells_y**2 + self.cells_z**2)
         M = None
+        w = self.cells_B1/np.mean(self.cells_B1)
         while rk_res.status == "running":
             M = rk_res.y.reshape((3, self.N_cells))
             Mx, My, Mz = M[0], M[1], M[2]
-            w = self.cells_B1/np.mean(self.cells_B1)
             history.append((rk_res.t, np.mean(w*Mx), np.mean(w*My), np.mean(w*Mz), Mx[central_cell], My[central_cell], Mz[central_cell]))
             rk_res.step()
         M = rk_res.y.reshape((3, self.N_cells))
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from scipy import integrate
 from ..units import *
 
 class Coil(object):
@@ -9,7 +8,7 @@ class Coil(object):
 
     You can calculate the magnetic field cause by the coil at any point in space.
     """
-    def __init__(self, turns, length, diameter, current, use_biot_savart=False):
+    def __init__(self, turns, length, diameter, current, use_biot_savart=False, nodes_per_turn=64):
         r""" Generates a coil objsect.
 
         Parameters:
@@ -17,6 +16,8 @@ class Coil(object):
         * length: float
         * diameter: float
         * current: float
+        * nodes_per_turn: int, number of Gauss-Legendre nodes per turn used to
+                          integrate the Biot-Savart law along the coil wire
         """
         self.turns = turns
         self.length = length
@@ -24,7 +25,25 @@ class Coil(object):
         self.current = current
         self.use_biot_savart = use_biot_savart
 
-    def B_field(self, x, y, z):
+        # Composite Gauss-Legendre rule along the helix parameter phi in
+        # [0, 2 pi turns], one rule per turn and a scaled one for a fractional
+        # last turn. The coil geometry is fixed, so the wire positions and
+        # directions at the nodes are only calculated once.
+        nodes, weights = np.polynomial.legendre.leggauss(nodes_per_turn)
+        full_turns = int(np.floor(self.turns))
+        segments = [(2*np.pi*k, 1.) for k in range(full_turns)]
+        if self.turns > full_turns:
+            segments.append((2*np.pi*full_turns, self.turns-full_turns))
+        phi = np.concatenate([start + np.pi*frac*(nodes+1) for start, frac in segments])
+        self.quad_weights = np.concatenate([np.pi*frac*weights for start, frac in segments])
+        self.lx = self.radius*np.sin(phi)
+        self.ly = self.radius*np.cos(phi)
+        self.lz = self.length/2 * (phi/(np.pi*self.turns)-1)
+        self.dlx = self.ly
+        self.dly = -self.lx
+        self.dlz = self.length/(2*np.pi*self.turns)
+
+    def B_field(self, x, y, z, chunk_size=30000):
         r"""The magnetic field of the coil
         Assume Biot-Savart law
         vec(B)(vec(r)) = µ0 / 4π ∮ I dvec(L) × vec(r)' / |vec(r)'|³
@@ -40,29 +59,36 @@ class Coil(object):
               vec(B)(vec(r))  = µ0 / 4π ∭_V  (vec(J) dV) × vec(r)' / |vec(r)'|³
             - closed loop
             - constant current, can factor out the I from integral
-        """
 
-        phi = np.linspace(0, 2*np.pi*self.turns, 10000)
-        sPhi = np.sin(phi)
-        cPhi = np.cos(phi)
-        lx = self.radius*sPhi
-        ly = self.radius*cPhi
-        lz = self.length/2 * (phi/(np.pi*self.turns)-1)
-        dlx = ly
-        dly = -lx
-        dlz = self.length/(2*np.pi*self.turns)
+        The line integral is evaluated with the Gauss-Legendre nodes set up
+        in __init__.
 
-        dist = np.sqrt((lx-x)**2+(ly-y)**2+(lz-z)**2)
+        x, y and z can be arrays, in which case the field is calculated for all
+        points at once and B_x, B_y and B_z are arrays of the broadcasted shape.
+        The points are processed in chunks of about `chunk_size` (point, node)
+        pairs, which keeps the temporary arrays small enough to stay in cache.
+        """
+        x, y, z = np.broadcast_arrays(x, y, z)
+        shape = x.shape
+        x, y, z = x.ravel(), y.ravel(), z.ravel()
 
-        integrand_x = ( dly * (z-lz) - dlz * (y-ly) ) / dist**3
-        integrand_y = ( dlz * (x-lx) - dlx * (z-lz) ) / dist**3
-        integrand_z = ( dlx * (y-ly) - dly * (x-lx) ) / dist**3
+        B = np.empty((3, x.size))
+        chunk = max(1, int(chunk_size/len(self.lx)))
+        for sl in (slice(i, i+chunk) for i in range(0, x.size, chunk)):
+            rx = x[sl, None]-self.lx
+            ry = y[sl, None]-self.ly
+            rz = z[sl, None]-self.lz
+            # quadrature weights are folded into 1/|r|³
+            dist2 = rx*rx+ry*ry+rz*rz
+            w_dist3 = self.quad_weights/(dist2*np.sqrt(dist2))
 
-        B_x = mu0/(4*np.pi) * self.current * integrate.simps(integrand_x, x=phi)
-        B_y = mu0/(4*np.pi) * self.current * integrate.simps(integrand_y, x=phi)
-        B_z = mu0/(4*np.pi) * self.current * integrate.simps(integrand_z, x=phi)
+            B[0, sl] = np.sum( (self.dly * rz - self.dlz * ry) * w_dist3, axis=-1)
+            B[1, sl] = np.sum( (self.dlz * rx - self.dlx * rz) * w_dist3, axis=-1)
+            B[2, sl] = np.sum( (self.dlx * ry - self.dly * rx) * w_dist3, axis=-1)
+        B *= mu0/(4*np.pi) * self.current
 
-        return [B_x, B_y, B_z]
+        B_x, B_y, B_z = B.reshape((3,)+shape)
+        return [B_x[()], B_y[()], B_z[()]]
 
     def Bz(self, z):
         """ This is an analytical solution for the B_z component along the x=y=0
@@ -72,6 +98,5 @@ class Coil(object):
         n = self.turns / self.length
         I = self.current
         L = self.length
-        R = self.coil.radius
-        B_z = lambda z: mu0*n*I/2*((z+L/2)/np.sqrt(R**2+(z+L/2)**2)-(z-L/2)/np.sqrt(R**2+(z-L/2)**2))
-        return B_z(z)
+        R = self.radius
+        return mu0*n*I/2*((z+L/2)/np.sqrt(R**2+(z+L/2)**2)-(z-L/2)/np.sqrt(R**2+(z-L/2)**2))
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import numpy as np
 from ..units import *
 
 class RingMagnet(object):
@@ -87,21 +88,26 @@ class RingMagnet(object):
         """Evaluates magnetic field at position x, y, z
 
         Parameters:
-        * x: float, x position
-        * y: float, y position
-        * z: float, z position
+        * x: float or array, x position
+        * y: float or array, y position
+        * z: float or array, z position
 
         Returns:
         * array of length 3,  Magnetic field at position (x,y,z)
+          If x, y, z are arrays, each component is an array of the broadcasted shape.
         """
-        Bx = 0
-        By = 0
-        Bz = 0
+        shape = np.broadcast(x, y, z).shape
+        Bx = np.zeros(shape)
+        By = np.zeros(shape)
+        Bz = np.zeros(shape)
         for i in self.P.keys():
+            # most multipoles are not set, skip evaluating their polynomials
+            if self.An[i] == 0:
+                continue
             Bx += self.An[i]*self.P[i]["x"](x, y, z)
             By += self.An[i]*self.P[i]["y"](x, y, z)
             Bz += self.An[i]*self.P[i]["z"](x, y, z)
-        return [Bx, By, Bz]
+        return [Bx[()], By[()], Bz[()]]
 
     def __call__(self, x=0, y=0, z=0):
         """Evaluates magnetic field at position x, y, z
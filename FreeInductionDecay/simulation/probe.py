@@ -29,7 +29,7 @@ class NMRProbe(object):
         """Calculates the probes magnetization for a given B field value.
         B_field can be an array, in which case magnetization for each entry are calculated"""
         expon = self.material.magnetic_moment / (kB*self.temp) * B_field
-        nuclear_polarization = (np.exp(expon) - np.exp(-expon))/(np.exp(expon) + np.exp(-expon))
+        nuclear_polarization = np.tanh(expon)
         magnetizations = self.material.magnetic_moment * self.material.number_density * nuclear_polarization
         return magnetizations
 
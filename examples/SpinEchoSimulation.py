@@ -82,8 +82,8 @@ def run_spin_echo_simulation(lin_grad=0*ppm/cm, quad_grad=0*ppm/cm**2, N_cells=1
         plt.ylabel("phase in rad")
         plt.savefig("%s/Phase_function_%s.png"%(base_dir, grad_str), dpi=200)
 
-    fit_fid = PhaseFitFID(**{"frac": np.exp(-1), "tol": 1e-5, "smoothing": True, "probe": sim.probe, "edge_ignore": 60*us})
-    fit_echo = PhaseFitEcho(**{"frac": np.exp(-1), "tol": 1e-5, "smoothing": True, "probe": sim.probe})
+    fit_fid = PhaseFitFID(**{"frac": np.exp(-1), "smoothing": True, "probe": sim.probe, "edge_ignore": 60*us})
+    fit_echo = PhaseFitEcho(**{"frac": np.exp(-1), "smoothing": True, "probe": sim.probe})
 
     true_f = sim.mean_frequency()/kHz
     # extraction plot
@@ -149,7 +149,6 @@ if __name__=="__main__":
                                      noise_scale=0.2*pc,
                                      seed=1,
                                      frac=np.exp(-1),
-                                     tol=1e-5,
                                      base_dir="./plots/",
                                      smoothing=True,
                                      edge_ignore=60*us)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from .context import FreeInductionDecay, unittest
+from FreeInductionDecay.units import *
+from FreeInductionDecay.simulation.E989 import StorageRingMagnet, FixedProbe
+from FreeInductionDecay.simulation.FID_sim import FID_simulation
+
+class TestSinglePrecision(unittest.TestCase):
+    def generate_FID(self, dtype):
+        sim = FID_simulation(FixedProbe(), StorageRingMagnet(), N_cells=500, seed=1, dtype=dtype)
+        sim.apply_rf_field()
+        return sim.generate_FID()
+
+    def test_float32_matches_float64(self):
+        flux64, time64 = self.generate_FID(np.float64)
+        flux32, time32 = self.generate_FID(np.float32)
+        self.assertEqual(flux32.dtype, np.float64)
+        np.testing.assert_array_equal(time32, time64)
+        rms = np.sqrt(np.mean(flux64**2))
+        rms_diff = np.sqrt(np.mean((flux32-flux64)**2))
+        self.assertLess(rms_diff/rms, 1e-4)
+
+class TestFieldCallables(unittest.TestCase):
+    def check_field(self, b_field):
+        sim = FID_simulation(FixedProbe(), b_field, N_cells=100, seed=1)
+        self.assertEqual(sim.cells_B0.shape, (100,))
+        sim.apply_rf_field()
+        flux, time = sim.generate_FID()
+        self.assertTrue(np.all(np.isfinite(flux)))
+        return sim
+
+    def test_constant_field(self):
+        sim = self.check_field(lambda x, y, z: [0*T, 1.45*T, 0*T])
+        np.testing.assert_allclose(sim.cells_B0, 1.45*T)
+
+    def test_scalar_and_array_components(self):
+        sim = self.check_field(lambda x, y, z: [0*T, 1.45*T + 1e-6*T*z/mm, 0*T])
+        np.testing.assert_allclose(sim.cells_B0, 1.45*T + 1e-6*T*sim.cells_z/mm)
+
+    def test_scalar_only_field(self):
+        def b_field(x, y, z):
+            if np.ndim(z) != 0:
+                raise TypeError("only scalars")
+            return [0*T, 1.45*T + 1e-6*T*z/mm, 0*T]
+        sim = self.check_field(b_field)
+        np.testing.assert_allclose(sim.cells_B0, 1.45*T + 1e-6*T*sim.cells_z/mm)
+
+if __name__ == '__main__':
+    unittest.main()
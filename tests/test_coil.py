@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from .context import FreeInductionDecay, unittest
+from FreeInductionDecay.units import *
+from FreeInductionDecay.simulation.E989 import FixedProbe, PlungingProbe
+
+class TestCoilBField(unittest.TestCase):
+    def test_array_matches_scalar(self):
+        rng = np.random.RandomState(0)
+        for probe in [FixedProbe(), PlungingProbe()]:
+            x, y, z = probe.random_samples(rng, 50)
+            B_array = np.array(probe.coil.B_field(x, y, z))
+            B_scalar = np.array([probe.coil.B_field(*point) for point in zip(x, y, z)]).T
+            self.assertEqual(B_array.shape, (3, 50))
+            np.testing.assert_allclose(B_array, B_scalar, rtol=1e-12, atol=1e-12*np.max(np.abs(B_scalar)))
+
+    def test_broadcasting(self):
+        coil = FixedProbe().coil
+        z = np.linspace(-5, 5, 11)*mm
+        B = coil.B_field(0, 0, z)
+        for B_i in B:
+            self.assertEqual(np.shape(B_i), z.shape)
+        self.assertEqual(np.shape(coil.B_field(0, 0, 0)[2]), ())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from .context import FreeInductionDecay, unittest
+from FreeInductionDecay.units import *
+from FreeInductionDecay.analysis.phase_fit import PhaseFitFID, PhaseFitRan
+
+class Probe(object):
+    time_pretrigger = 0*ms
+    readout_length = 1*ms
+
+class TestPhaseFitFIDChi2(unittest.TestCase):
+    def make_fit(self, fit_mode, params, noise=0):
+        rng = np.random.RandomState(1)
+        fit = PhaseFitFID(probe=Probe(), fit_mode=fit_mode)
+        fit.time = np.arange(1000)*us
+        fit.t_range = np.array([100*us, 900*us])
+        fit.fit_slice = slice(101, 900)
+        fit.env = np.exp(-fit.time/(0.5*ms))
+        fit.noise = 0.01
+        fit.width = fit.t_range[1] - fit.t_range[0]
+        fit.phase = fit.fit_func((fit.time-fit.t0)/fit.width, params) + rng.normal(scale=noise, size=fit.time.size)
+        return fit
+
+    def test_recovers_coefficients(self):
+        for fit_mode, params in [("t5_odd", [0.3, 2.0, -0.1, 0.05]),
+                                 ("t4_all", [0.3, 2.0, 0.4, -0.1, 0.05])]:
+            res = self.make_fit(fit_mode, params).chi2_fit()
+            self.assertTrue(res.success)
+            np.testing.assert_allclose(res.x, params, rtol=1e-8, atol=1e-10)
+
+    def test_chi2_is_weighted_sse(self):
+        for fit_mode, params in [("t5_odd", [0.3, 2.0, -0.1, 0.05]),
+                                 ("t4_all", [0.3, 2.0, 0.4, -0.1, 0.05])]:
+            fit = self.make_fit(fit_mode, params, noise=1e-3)
+            res = fit.chi2_fit()
+            sl = fit.fit_slice
+            residuals = fit.fit_func((fit.time[sl]-fit.t0)/fit.width, res.x) - fit.phase[sl]
+            chi2 = np.sum((residuals*fit.env[sl]/fit.noise)**2)
+            self.assertGreater(chi2, 0)
+            self.assertAlmostEqual(res.fun/chi2, 1, delta=1e-10)
+
+    def test_rank_deficient_range(self):
+        fit = self.make_fit("t5_odd", [0.3, 2.0, -0.1, 0.05])
+        # two points can not determine four parameters
+        fit.fit_slice = slice(101, 103)
+        res = fit.chi2_fit()
+        self.assertFalse(res.success)
+
+class TestPhaseFitRanBatch(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.time = np.arange(4096)*us
+        # generated frequencies in Hz, as returned by the fit
+        self.frequencies = 50000 + rng.uniform(-2000, 2000, size=8)
+        self.fluxes = np.array([np.sin(2*np.pi*f/s*self.time + rng.uniform(0, 2*np.pi))
+                                *np.exp(-self.time/(1.5*ms))*(self.time > 0.4*ms)
+                                + rng.normal(scale=0.01, size=self.time.size) for f in self.frequencies])
+
+    def test_batch_matches_single_fits(self):
+        fit = PhaseFitRan(t0=0)
+        single = np.array([fit.fit(self.time, flux, 0) for flux in self.fluxes])
+        batch = fit.fit_batch(self.time, self.fluxes, range(len(self.fluxes)))
+        self.assertEqual(batch.shape, (len(self.fluxes),))
+        np.testing.assert_allclose(batch, single, rtol=1e-12)
+        np.testing.assert_allclose(single, self.frequencies, rtol=2e-3)
+
+class TestPhaseFitRanRange(unittest.TestCase):
+    def test_no_edge_ignore_without_decay(self):
+        # with edge_ignore = 0 and an envelope that never drops, the fit range
+        # has to end at the last sample
+        time = np.arange(4096)*us
+        fit = PhaseFitRan(t0=0)
+        fit.edge_ignore = 0
+        freq = fit.fit(time, np.sin(2*np.pi*50*kHz*time), 0)
+        self.assertAlmostEqual(freq/50000, 1, delta=1e-3)
+
+if __name__ == '__main__':
+    unittest.main()